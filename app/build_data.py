@@ -0,0 +1,15 @@
+import os
+from gatherData import build_static_data
+
+
+def main():
+    """
+    Convert the static data sets in app/data to Feather files that the app loads instead of parsing the CSV files.
+    Run this once when building or deploying the app, from the root of the repository
+    """
+    for feather_path in build_static_data(os.path.join(os.getcwd(), "app", "data")):
+        print(f"Wrote {feather_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,41 @@
 import csv
+import glob
+import hashlib
+import json
+import os
+import pickle
+import time
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow.feather as feather
 import urllib.parse
 import requests
 
 
-def query_arcgis_feature_server(url_feature_server=''):
+def read_arcgis_features(response_text, return_geometry=True):
+    """
+    Parse the features returned by an ArcGIS feature server query
+
+    Parameters:
+        response_text : string
+            Text of the query response. GeoJSON if geometry was requested, Esri JSON otherwise.
+        return_geometry : bool
+            Whether the query requested geometry.
+
+    Returns:
+        features : gpd.GeoDataFrame or pd.DataFrame
+            GeoDataFrame of the features if geometry was requested, otherwise a DataFrame
+            of the feature attributes only.
+    """
+    if return_geometry:
+        return gpd.read_file(response_text, driver='GeoJSON')
+    features = json.loads(response_text)['features']
+    return pd.DataFrame([feature['attributes'] for feature in features])
+
+
+def query_arcgis_feature_server(url_feature_server='', out_fields=None, where=None, return_geometry=True,
+                                geometry_precision=None, max_allowable_offset=None):
     """
     This function downloads all of the features available on a given ArcGIS
     feature server. The function is written to bypass the limitations imposed
@@ -18,6 +47,20 @@ def query_arcgis_feature_server(url_feature_server=''):
             Sting containing the URL of the service API you want to query. It should
             end in a forward slash and look something like this:
             'https://services.arcgis.com/P3ePLMYs2RVChkJx/arcgis/rest/services/USA_Counties/FeatureServer/0/'
+        out_fields : list of strings
+            Names of the fields to download. All fields are downloaded if not provided.
+            The object ID field is always included.
+        where : string
+            SQL where clause used to filter the features on the server, for example
+            "State_Abbreviation = 'MI'". All features are downloaded if not provided.
+        return_geometry : bool
+            If False only the attributes are downloaded, which is much smaller and
+            faster to parse than the full geometry.
+        geometry_precision : int
+            Number of decimal places of the returned coordinates.
+        max_allowable_offset : float
+            Maximum distance, in the units of the output spatial reference, the
+            server may move vertices when simplifying the returned geometry.
 
     Returns:
         geodata_final : gpd.GeoDataFrame
@@ -27,7 +70,8 @@ def query_arcgis_feature_server(url_feature_server=''):
             including, but not limited to, Shapefile (.shp), GeoJSON (.geojson),
             GeoPackage (.gpkg), or PostGIS.
             See https://geopandas.org/en/stable/docs/user_guide/io.html#writing-spatial-data
-            for more details.
+            for more details. If `return_geometry` is False this is a pd.DataFrame
+            of the feature attributes instead.
     """
     if url_feature_server == '':
         geodata_final = gpd.GeoDataFrame()
@@ -52,9 +96,15 @@ def query_arcgis_feature_server(url_feature_server=''):
     # go beyond this limit.
     record_count_max = layer_def['maxRecordCount']
 
+    # Server side filter given by the caller. It is added to every query, the
+    # object ID query and each block query, so features that don't match it
+    # are never returned even when their ID falls inside a block.
+    where_prefix = f'({where}) and ' if where else ''
+
     # Part of the URL that specifically requests only the object IDs
+    readable_ids_where = f'{where_prefix}{fid_colname} is not null'
     url_query_get_ids = (f'query?f=geojson&returnIdsOnly=true'
-                         f'&where={fid_colname}+is+not+null')
+                         f'&where={urllib.parse.quote(readable_ids_where)}')
 
     url_comb = url_feature_server + url_query_get_ids
 
@@ -66,8 +116,21 @@ def query_arcgis_feature_server(url_feature_server=''):
     # parts will, at the end, be concatenated into one large GeoDataFrame.
     geodata_parts = []
 
-    # This part of the query is fixed and never actually changes
-    url_query_fixed = ('query?f=geojson&outFields=*&where=')
+    # This part of the query is fixed and never actually changes. Only the
+    # requested fields and geometry are downloaded, the object ID field is
+    # always needed to check the result.
+    if out_fields is None:
+        url_out_fields = '*'
+    else:
+        url_out_fields = ','.join([fid_colname] + [field for field in out_fields if field != fid_colname])
+    query_params = {'f': 'geojson' if return_geometry else 'json',
+                    'outFields': url_out_fields,
+                    'returnGeometry': 'true' if return_geometry else 'false'}
+    if return_geometry and geometry_precision is not None:
+        query_params['geometryPrecision'] = geometry_precision
+    if return_geometry and max_allowable_offset is not None:
+        query_params['maxAllowableOffset'] = max_allowable_offset
+    url_query_fixed = 'query?' + urllib.parse.urlencode(query_params) + '&where='
 
     # Identifying the largest query size allowed per request. This will dictate
     # how many queries will need to be made. We start the search at
@@ -76,13 +139,13 @@ def query_arcgis_feature_server(url_feature_server=''):
     # shrink the query size until the test query goes through without
     # generating a time-out error.
     block_size = min(record_count_max, len(all_objectids))
-    worked = False
+    worked = block_size == 0
     while not worked:
         # Moving the "cursors" to their appropriate locations
         id_start = all_objectids[0]
         id_end = all_objectids[block_size - 1]
 
-        readable_query_string = (f'{fid_colname}>={id_start} '
+        readable_query_string = (f'{where_prefix}{fid_colname}>={id_start} '
                                  f'and {fid_colname}<={id_end}')
 
         url_query_variable = urllib.parse.quote(readable_query_string)
@@ -94,7 +157,7 @@ def query_arcgis_feature_server(url_feature_server=''):
         if 'error' in url_get.json():
             block_size = int(block_size / 2) + 1
         else:
-            geodata_part = gpd.read_file(url_get.text)
+            geodata_part = read_arcgis_features(url_get.text, return_geometry)
 
             geodata_parts.append(geodata_part.copy())
             worked = True
@@ -108,7 +171,7 @@ def query_arcgis_feature_server(url_feature_server=''):
         id_start = sub_list[0]
         id_end = sub_list[-1]
 
-        readable_query_string = (f'{fid_colname}>={id_start} '
+        readable_query_string = (f'{where_prefix}{fid_colname}>={id_start} '
                                  f'and {fid_colname}<={id_end}')
 
         # Encoding from readable text to URL
@@ -119,13 +182,15 @@ def query_arcgis_feature_server(url_feature_server=''):
 
         # Actually performing the query and storing its results in a
         # GeoDataFrame
-        geodata_part = (gpd.read_file(url_comb,
-                                      driver='GeoJSON'))
+        geodata_part = read_arcgis_features(requests.get(url_comb).text, return_geometry)
 
         # Appending the result to `geodata_parts`
         if geodata_part.shape[0] > 0:
             geodata_parts.append(geodata_part)
 
+    if len(geodata_parts) == 0:
+        return gpd.GeoDataFrame() if return_geometry else pd.DataFrame()
+
         # Concatenating all of the query parts into one large GeoDataFrame
     geodata_final = (pd.concat(geodata_parts,
                                ignore_index=True)
@@ -174,3 +239,242 @@ def query_cms_api(url):
         rows.append(row)
     df = pd.DataFrame(rows[1:], columns=rows[0])
     return df
+
+
+def hash_rows_by_key(df, key='facility_id'):
+    """
+    Compute a fingerprint of all rows belonging to each key of a dataframe. Row hashes are summed per key so the
+    fingerprint doesn't depend on the order the rows were returned in
+
+    Parameters:
+        df: Pandas dataframe to fingerprint
+        key: Column name identifying the entity each row belongs to
+
+    Returns:
+        Pandas series of uint64 fingerprints indexed by key
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    return row_hashes.groupby(df[key].to_numpy()).sum()
+
+
+def diff_key_hashes(previous, current):
+    """
+    Compare the per-key fingerprints of two snapshots of the same dataset
+
+    Parameters:
+        previous: Pandas series of fingerprints from the previous snapshot, as returned by hash_rows_by_key
+        current: Pandas series of fingerprints from the current snapshot, as returned by hash_rows_by_key
+
+    Returns:
+        Two sets, one containing the keys that are new or whose rows changed and one containing the keys that were
+        removed
+    """
+    common = current.index.intersection(previous.index)
+    modified = common[current[common].to_numpy() != previous[common].to_numpy()]
+    added = current.index.difference(previous.index)
+    removed = previous.index.difference(current.index)
+    return set(modified) | set(added), set(removed)
+
+
+def build_static_data(data_dir):
+    """
+    Convert every CSV file in a directory to an uncompressed Feather file next to it, so the data sets can be loaded
+    without parsing the CSV files
+
+    Parameters:
+        data_dir: Path of the directory containing the CSV files
+
+    Returns:
+        List of paths of the Feather files that were written
+    """
+    written = []
+    for csv_path in sorted(glob.glob(os.path.join(data_dir, "*.csv"))):
+        feather_path = os.path.splitext(csv_path)[0] + ".feather"
+        pd.read_csv(csv_path).to_feather(feather_path, compression="uncompressed")
+        written.append(feather_path)
+    return written
+
+
+def read_static_data(csv_path):
+    """
+    Read a static data set. The Feather copy written by build_static_data is used when it is up to date, otherwise the
+    CSV file is parsed. The Feather file is memory mapped while it is read, but the returned dataframe is a private
+    copy owned by the calling process
+
+    Parameters:
+        csv_path: Path of the CSV file of the data set
+
+    Returns:
+        Contents of the data set as a Pandas dataframe
+    """
+    feather_path = os.path.splitext(csv_path)[0] + ".feather"
+    if os.path.exists(feather_path) and os.path.getmtime(feather_path) >= os.path.getmtime(csv_path):
+        return feather.read_table(feather_path, memory_map=True).to_pandas()
+    return pd.read_csv(csv_path)
+
+
+def share_array(array, cache_dir, prefix, max_age=24*60*60):
+    """
+    Store a numpy array in a .npy file named after a hash of its contents and return a memory-mapped view of it, so
+    processes that derive the same array share one page-cached copy. The view is copy-on-write, writes to it stay
+    private to the process and never reach the file. The file is touched whenever it is reused, and files with the
+    same prefix that haven't been used for max_age are removed
+
+    Parameters:
+        array: Numpy array to share
+        cache_dir: Path of the directory the .npy files are stored in
+        prefix: Prefix of the .npy file names
+        max_age: Age in seconds after which other files with the same prefix are removed
+
+    Returns:
+        Memory-mapped numpy array with the same contents as array
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.tobytes()).hexdigest()[:16]
+    file_path = os.path.join(cache_dir, f"{prefix}_{digest}.npy")
+    try:
+        # Touched on every use so other processes never prune a file that is still current
+        os.utime(file_path)
+        return np.load(file_path, mmap_mode="c")
+    except FileNotFoundError:
+        # Not written yet, or pruned by another process since it was last used
+        pass
+    # Written to a temporary file first so other processes never map a partially written file
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    np.save(temp_path, array)
+    os.replace(temp_path + ".npy", file_path)
+    prune_cache_files(cache_dir, prefix, file_path, max_age)
+    return np.load(file_path, mmap_mode="c")
+
+
+def prune_cache_files(cache_dir, prefix, keep_path, max_age):
+    """
+    Remove the files in a cache directory with the given prefix that are older than max_age
+
+    Parameters:
+        cache_dir: Path of the cache directory
+        prefix: Prefix of the file names to prune
+        keep_path: Path of a file that is never removed
+        max_age: Age in seconds after which files are removed
+    """
+    for old_path in glob.glob(os.path.join(cache_dir, f"{prefix}_*")):
+        try:
+            if old_path != keep_path and time.time() - os.path.getmtime(old_path) > max_age:
+                os.remove(old_path)
+        except FileNotFoundError:
+            # Already removed by another process
+            pass
+
+
+def hash_dataframe(df):
+    """
+    Compute a hash of the contents of a dataframe, including the order of its rows
+
+    Parameters:
+        df: Pandas dataframe to hash
+
+    Returns:
+        Hex digest of the hash
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha1(row_hashes.tobytes() + ",".join(map(str, df.columns)).encode()).hexdigest()
+
+
+def disk_cached(cache_dir, prefix, key_parts, compute, max_age=7*24*60*60):
+    """
+    Load a result stored on disk under a hash of the given key parts, or compute and store it if it hasn't been stored
+    yet. This lets results survive restarts and be shared by new processes as long as the inputs they were computed
+    from don't change. The pandas and numpy versions are part of the key, since pickles written by other versions of
+    them may not load. Files with the same prefix older than max_age are removed when a new result is stored
+
+    Parameters:
+        cache_dir: Path of the directory the results are stored in
+        prefix: Prefix of the file names
+        key_parts: List of values identifying the inputs of the result, their repr is hashed
+        compute: Function called without arguments to compute the result, which must be picklable
+        max_age: Age in seconds after which other files with the same prefix are removed
+
+    Returns:
+        The stored or computed result
+    """
+    digest = hashlib.sha1(repr([pd.__version__, np.__version__] + list(key_parts)).encode()).hexdigest()[:16]
+    file_path = os.path.join(cache_dir, f"{prefix}_{digest}.pkl")
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # Unreadable file (truncated, or pickled by incompatible library versions), the result is recomputed and
+            # the file replaced
+            pass
+    result = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temporary file first so other processes never read a partially written file
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(result, f)
+    os.replace(temp_path, file_path)
+    prune_cache_files(cache_dir, prefix, file_path, max_age)
+    return result
+
+
+def partition_geodataframe(gdf, column):
+    """
+    Split a GeoDataFrame into one GeoDataFrame per value of a column and precompute the bounds of each part, so
+    looking up the features or bounds of a value doesn't require filtering the whole GeoDataFrame
+
+    Parameters:
+        gdf: GeoPandas dataframe to partition
+        column: Name of the column to partition on
+
+    Returns:
+        Dictionary containing the full GeoDataFrame ("data"), a dictionary of GeoDataFrames per value ("partitions")
+        and a dictionary of [minx, miny, maxx, maxy] bounds per value ("bounds")
+    """
+    partitions, bounds = {}, {}
+    if len(gdf) > 0:
+        for value, part in gdf.groupby(column):
+            partitions[value] = part
+            bounds[value] = part.total_bounds
+    return {"data": gdf,
+            "partitions": partitions,
+            "bounds": bounds}
+
+
+def select_partitions(partitioned, values):
+    """
+    Get the features of one or more values from a partitioned GeoDataFrame. A single value is returned without
+    copying, several values are concatenated
+
+    Parameters:
+        partitioned: Dictionary returned by partition_geodataframe
+        values: List of values to select
+
+    Returns:
+        GeoPandas dataframe of the features of the selected values
+    """
+    parts = [partitioned["partitions"][value] for value in values if value in partitioned["partitions"]]
+    if len(parts) == 0:
+        return partitioned["data"].iloc[:0]
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts)
+
+
+def partition_bounds(partitioned, values):
+    """
+    Get the bounds covering one or more values of a partitioned GeoDataFrame from their precomputed bounds
+
+    Parameters:
+        partitioned: Dictionary returned by partition_geodataframe
+        values: List of values to cover
+
+    Returns:
+        [[south, west], [north, east]] bounds as expected by folium, or None if none of the values has any features
+    """
+    bounds = np.array([partitioned["bounds"][value] for value in values if value in partitioned["bounds"]])
+    if len(bounds) == 0:
+        return None
+    return [[float(bounds[:, 1].min()), float(bounds[:, 0].min())],
+            [float(bounds[:, 3].max()), float(bounds[:, 2].max())]]
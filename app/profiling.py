@@ -0,0 +1,113 @@
+import cProfile
+import functools
+import os
+import pstats
+import threading
+import time
+import pandas as pd
+
+# Environment variables used to switch on profiling and to choose where the profiles are written
+PROFILE_ENV_VAR = "HOSPITAL_APP_PROFILE"
+PROFILE_DIR_ENV_VAR = "HOSPITAL_APP_PROFILE_DIR"
+PROFILE_TARGETS = ["main", "recommend_hospitals", "query_arcgis_feature_server"]
+# Tracks whether a profile is already running in the current thread, which can only have one profiler at a time
+_active = threading.local()
+
+
+def profile_targets(query_params=None):
+    """
+    Find which functions should be profiled. Targets are given as a comma separated list either in the
+    HOSPITAL_APP_PROFILE environment variable or in the profile URL query parameter, for example ?profile=main
+
+    Parameters:
+        query_params: Dictionary of URL query parameters as returned by st.experimental_get_query_params
+
+    Returns:
+        Set of the names of the functions to profile, empty if profiling is switched off
+    """
+    requested = os.environ.get(PROFILE_ENV_VAR, "").split(",")
+    if query_params:
+        for value in query_params.get("profile", []):
+            requested.extend(value.split(","))
+    return {target.strip() for target in requested if target.strip() in PROFILE_TARGETS}
+
+
+def profile_dir():
+    """
+    Directory profiles are written to, set with the HOSPITAL_APP_PROFILE_DIR environment variable
+
+    Returns:
+        Path of the directory
+    """
+    return os.environ.get(PROFILE_DIR_ENV_VAR, os.path.join(os.getcwd(), "profiles"))
+
+
+def hotspot_table(stats, top_n=15):
+    """
+    Summarize the functions that took the most time in a profile
+
+    Parameters:
+        stats: pstats.Stats of the profile
+        top_n: Number of functions to include
+
+    Returns:
+        Pandas dataframe of the top_n functions sorted by the time spent in the function itself
+    """
+    rows = []
+    for (file_name, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({"function": f"{function} ({os.path.basename(file_name)}:{line})",
+                     "calls": calls,
+                     "tottime": tottime,
+                     "cumtime": cumtime})
+    return pd.DataFrame(rows, columns=["function", "calls", "tottime", "cumtime"]) \
+        .sort_values("tottime", ascending=False).head(top_n).reset_index(drop=True)
+
+
+def profile_call(reports, func, *args, **kwargs):
+    """
+    Call a function under cProfile, write the profile to a .pstats file in the profile directory and add a report of
+    it to reports. The .pstats file can be opened with pstats or turned into a flamegraph with tools like snakeviz.
+    Only the calling thread is profiled, so functions run in other threads have to be profiled on their own. A thread
+    can only run one profiler, so a call made while the thread is already being profiled is run unprofiled and is
+    covered by the report of the enclosing call instead
+
+    Parameters:
+        reports: List the report (function name, .pstats path and hotspot table) is appended to
+        func: Function to profile
+        args: Positional arguments to call func with
+        kwargs: Keyword arguments to call func with
+
+    Returns:
+        Return value of func
+    """
+    if getattr(_active, "profiling", False):
+        return func(*args, **kwargs)
+    profiler = cProfile.Profile()
+    _active.profiling = True
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        _active.profiling = False
+        os.makedirs(profile_dir(), exist_ok=True)
+        file_name = f"{func.__name__}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.pstats"
+        file_path = os.path.join(profile_dir(), file_name)
+        profiler.dump_stats(file_path)
+        reports.append((func.__name__, file_path, hotspot_table(pstats.Stats(profiler))))
+
+
+def profiled(func, reports):
+    """
+    Wrap a function so every call of it is profiled with profile_call. Functions are only wrapped when profiling is
+    switched on, so there is no overhead otherwise
+
+    Parameters:
+        func: Function to profile
+        reports: List the reports of the calls are appended to
+
+    Returns:
+        Wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return profile_call(reports, func, *args, **kwargs)
+    return wrapper
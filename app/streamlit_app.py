@@ -1,16 +1,18 @@
 import os.path
 import folium
 import math
-import random
+import threading
+import time
 import altair as alt
 import pandas as pd
 import streamlit as st
 import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_folium import folium_static
-from sklearn.metrics.pairwise import cosine_similarity
 from gatherData import *
+from profiling import profile_call, profile_targets, profiled
 pd.set_option('mode.chained_assignment', None)
-random.seed(42)
 
 # CSS to inject that hides row index when displaying Pandas dataframe in Streamlit app
 hide_table_row_index = """
@@ -20,47 +22,141 @@ hide_table_row_index = """
             </style>
             """
 
+# Hospital survey columns used as the recommendation feature vector and the matching keys of a user query
+RATING_COLUMNS = ['doctors', 'nurses', 'staffs', 'patients']
+QUERY_RATING_KEYS = ['doctor_rating', 'nurses_rating', 'staff_rating', 'patient_rating']
+# Factor the 1-5 star overall hospital rating is multiplied by to put it on the 0-100 scale of the survey measures
+OVERALL_RATING_SCALE = 20
+# Endings of the HCAHPS measure ids counting answers other than the best one ("sometimes or never", "usually", "no",
+# "agree" or "disagree" rather than "strongly agree", hospital ratings of 0-6 or 7-8, "probably yes" or "no" to
+# recommending the hospital), so a lower response rate is better for them
+LOW_IS_BETTER_SUFFIXES = ("_SN_P", "_U_P", "_N_P", "_A", "_D_SD", "_0_6", "_7_8", "_PY", "_DN")
+
+CMS_RATINGS_URL = "https://data.cms.gov/provider-data/api/1/datastore/query/xubh-q36u/0/download?format=csv"
+CMS_SURVEY_URL = "https://data.cms.gov/provider-data/api/1/datastore/query/dgck-syfz/0/download?format=csv"
+
+COVID_FEATURE_SERVER_URL = ('https://services5.arcgis.com/qWZ7BaZXaP5isnfT/arcgis/rest/services/'
+                            'Community_Profile_Report_Counties/FeatureServer/0/')
+# County-level COVID-19 fields shown on the map tooltips and in the county table
+COVID_FIELDS = ['County', 'State_Abbreviation', 'Cases_last_7_days', 'Deaths_last_7_days', 'Cases_percent_change',
+                'Cumulative_cases', 'Cumulative_deaths']
+
 
 @st.cache(ttl=3*60*60, suppress_st_warning=True)
 def load_state_locations():
     """
-    Load the statelatlong.csv file as a GeoPandas dataframe
+    Load the statelatlong.csv file as a GeoPandas dataframe, using the Feather copy if it has been built
 
     Returns:
         Contents of statelatlong.csv as a GeoPandas dataframe
     """
     file_path = os.path.join(os.getcwd(), "app", "data", "statelatlong.csv")
-    state_coordinates = pd.read_csv(file_path)
+    state_coordinates = read_static_data(file_path)
     df = gpd.GeoDataFrame(state_coordinates, geometry=gpd.points_from_xy(state_coordinates.Longitude, state_coordinates.Latitude))
     df.dropna(inplace=True)
     return df
 
 
+@st.cache(ttl=3*60*60, suppress_st_warning=True, allow_output_mutation=True)
+def index_state_locations(state_locations):
+    """
+    Build a lookup of the default location of each state so it doesn't need to be filtered out of the state locations
+    on every rerun
+
+    Parameters:
+        state_locations: state locations GeoPandas dataframe
+
+    Returns:
+        Dictionary of state abbreviation to (latitude, longitude)
+    """
+    return dict(zip(state_locations["State"], zip(state_locations["Latitude"], state_locations["Longitude"])))
+
+
 @st.cache(ttl=3*60*60, suppress_st_warning=True)
 def load_hospital_locations():
     """
-    Load the us_hospital_locations.csv file as Pandas dataframe
+    Load the us_hospital_locations.csv file as Pandas dataframe, using the Feather copy if it has been built
 
     Returns:
         Contents of us_hospital_locations.csv as a Pandas dataframe
     """
     file_path = os.path.join(os.getcwd(), "app", "data", "us_hospital_locations.csv")
-    hospital_coordinates = pd.read_csv(file_path)
+    hospital_coordinates = read_static_data(file_path)
     df = gpd.GeoDataFrame(hospital_coordinates, geometry=gpd.points_from_xy(hospital_coordinates.LONGITUDE, hospital_coordinates.LATITUDE))
     df.dropna(inplace=True)
     return df
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def load_hospital_ratings():
+def run_timed(timings, name, ctx, func, *args):
     """
-    Load CMS hospital ratings data setusing the CMS API, filtering the data to only keep hospitals with available
-    ratings and emergency services
+    Call a loader from a thread pool worker and record how long it took
+
+    Parameters:
+        timings: Dictionary the duration in seconds is stored in under name
+        name: Name of the loader
+        ctx: Streamlit ScriptRunContext of the script thread, attached to the worker so cached functions can use it
+        func: Loader function to call
+        args: Arguments to call func with
+
+    Returns:
+        Return value of func
+    """
+    add_script_run_ctx(threading.current_thread(), ctx)
+    start = time.perf_counter()
+    result = func(*args)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def load_app_data():
+    """
+    Load every data set used by the app. The state locations, the COVID-19 data, the hospital locations and the two
+    CMS downloads are independent and loaded at the same time in a thread pool; only the processing of the CMS data,
+    which merges it with the hospital locations, waits for the downloads and the hospital locations. A cold start
+    therefore takes about as long as the slowest download plus the processing instead of the sum of all of them
+
+    Returns:
+        Dictionary of the loaded data sets and a dictionary of the duration in seconds of each loader along with the
+        critical path and total wall clock time
+    """
+    ctx = get_script_run_ctx()
+    timings = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        state_future = executor.submit(run_timed, timings, "load_state_locations", ctx, load_state_locations)
+        covid_future = executor.submit(run_timed, timings, "gather_covid_data", ctx, gather_covid_data)
+        locations_future = executor.submit(run_timed, timings, "load_hospital_locations", ctx, load_hospital_locations)
+        ratings_future = executor.submit(run_timed, timings, "download_hospital_ratings", ctx, download_cms_data,
+                                         CMS_RATINGS_URL)
+        survey_future = executor.submit(run_timed, timings, "download_hospital_survey", ctx, download_cms_data,
+                                        CMS_SURVEY_URL)
+        hospital_gdf = locations_future.result()
+        hospital_future = executor.submit(run_timed, timings, "refresh_hospital_data", ctx, refresh_hospital_data,
+                                          hospital_gdf, ratings_future.result(), survey_future.result())
+        data = {"state_locations": state_future.result(),
+                "covid_data": covid_future.result(),
+                "hospital_gdf": hospital_gdf,
+                "hospital_data": hospital_future.result()}
+    timings["total"] = time.perf_counter() - start
+    timings["critical_path"] = max(timings["load_state_locations"],
+                                   timings["gather_covid_data"],
+                                   max(timings["load_hospital_locations"],
+                                       timings["download_hospital_ratings"],
+                                       timings["download_hospital_survey"]) + timings["refresh_hospital_data"])
+    return data, timings
+
+
+def clean_hospital_ratings(df):
+    """
+    Process raw CMS hospital ratings data, filtering the data to only keep hospitals with available ratings and
+    emergency services. Each row is processed independently so this can also be used on a subset of facilities
+
+    Parameters:
+        df: Raw hospital ratings Pandas dataframe as returned by the CMS API
 
     Returns:
-        Data retrieved from the CMS API for hospital ratings as a Pandas dataframe
+        Processed hospital ratings as a Pandas dataframe
     """
-    df = query_cms_api("https://data.cms.gov/provider-data/api/1/datastore/query/xubh-q36u/0/download?format=csv")
     df = df.iloc[:, :13].drop(columns=['phone_number', 'meets_criteria_for_promoting_interoperability_of_ehrs'])
     df = df[df["hospital_overall_rating"] != "Not Available"]
     df["hospital_overall_rating"] = df["hospital_overall_rating"].astype(int)
@@ -68,14 +164,18 @@ def load_hospital_ratings():
     return df
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def load_hospital_survey():
+def aggregate_hospital_survey(df):
     """
-    Load CMS hospital survey data set using the CMS API. Calculates positive response rate for given set of questions
-    binned by type (doctors, nurses, patients, staff)
+    Process raw CMS hospital survey data in a single aggregation pass. Keeps the response rate of every
+    HCAHPS measure as its own column (named by its hcahps_measure_id) and calculates the mean of the given set of
+    questions binned by type (doctors, nurses, patients, staff). Each facility is aggregated independently so this can
+    also be used on a subset of facilities
+
+    Parameters:
+        df: Raw hospital survey Pandas dataframe as returned by the CMS API
 
     Returns:
-        Data retrieve and processed from CMS API for hospital survey as a Pandas dataframe
+        Processed hospital survey as a Pandas dataframe with one row per facility
     """
     question_type_dict = {'H_COMP_1_A_P': "nurses",
                           'H_NURSE_RESPECT_A_P': "nurses",
@@ -92,7 +192,6 @@ def load_hospital_survey():
                           'H_MED_FOR_A_P': "staffs",
                           'H_SIDE_EFFECTS_A_P': "staffs"
                           }
-    df = query_cms_api("https://data.cms.gov/provider-data/api/1/datastore/query/dgck-syfz/0/download?format=csv")
     df = df[['facility_id', 'hcahps_measure_id', 'hcahps_question', 'hcahps_answer_percent']]
     df['hcahps_answer_percent'] = pd.to_numeric(df['hcahps_answer_percent'], errors='coerce')
     df = df.dropna(axis=0)
@@ -100,12 +199,42 @@ def load_hospital_survey():
     filtered_counts = counts[counts['hcahps_question'] == 72].reset_index()
     valid_facility_id = list(filtered_counts['facility_id'])
     df = df[df['facility_id'].isin(valid_facility_id)]
-    df["measurement_type"] = df.apply(lambda row: question_type_dict[row["hcahps_measure_id"]] if row["hcahps_measure_id"] in question_type_dict.keys() else "UNKNOWN", axis=1)
-    grouped = df.groupby(['facility_id', 'measurement_type']).mean()
-    grouped = grouped.drop("UNKNOWN", level="measurement_type").reset_index()
-    pivot = grouped.pivot(index="facility_id", columns="measurement_type", values="hcahps_answer_percent").reset_index()
+    pivot = df.pivot_table(index="facility_id", columns="hcahps_measure_id", values="hcahps_answer_percent",
+                           aggfunc="mean")
+    for measurement_type in RATING_COLUMNS:
+        measures = [measure for measure, bucket in question_type_dict.items()
+                    if bucket == measurement_type and measure in pivot.columns]
+        pivot[measurement_type] = pivot[measures].mean(axis=1)
+    pivot = pivot.reset_index()
     pivot.columns.name = None
-    return pivot
+    return pivot[['facility_id'] + RATING_COLUMNS + sorted(pivot.columns.drop(['facility_id'] + RATING_COLUMNS))]
+
+
+def measure_descriptions(df):
+    """
+    Get the question text of each HCAHPS measure
+
+    Parameters:
+        df: Raw hospital survey Pandas dataframe as returned by the CMS API
+
+    Returns:
+        Dictionary of hcahps_measure_id to hcahps_question
+    """
+    questions = df.drop_duplicates('hcahps_measure_id')
+    return dict(zip(questions['hcahps_measure_id'], questions['hcahps_question']))
+
+
+def default_measure_rating(measure):
+    """
+    Get the ideal rating suggested to users for a measure, the best end of the 1-100 scale given its polarity
+
+    Parameters:
+        measure: Column name of the measure in the hospital index
+
+    Returns:
+        1 for measures where a lower response rate is better, 100 otherwise
+    """
+    return 1 if measure.endswith(LOW_IS_BETTER_SUFFIXES) else 100
 
 
 @st.cache(ttl=3*60*60, suppress_st_warning=True, allow_output_mutation=True)
@@ -141,236 +270,667 @@ def merge_hospital_location_ratings(locations, ratings):
     return merged
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
+# Entries of the hospital data snapshot handed out to readers
+HOSPITAL_DATA_KEYS = ["measure_descriptions", "hospital_ratings", "hospital_survey", "survey_ratings", "hospital_index"]
+
+
+@st.cache(suppress_st_warning=True, allow_output_mutation=True)
+def get_hospital_data_snapshot():
+    """
+    Persistent store holding the last processed snapshot of the CMS data sets. Unlike the other cached functions this
+    has no ttl so the previous snapshot survives a refresh and can be diffed against the newly downloaded data
+
+    Returns:
+        Dictionary that is shared across reruns and sessions and updated by refresh_hospital_data while holding its lock
+    """
+    return {"lock": threading.Lock()}
+
+
+def build_hospital_data_snapshot(snapshot, hospital_gdf, raw_ratings, raw_survey):
+    """
+    Process the CMS data sets from scratch and store the results in the snapshot
+
+    Parameters:
+        snapshot: Dictionary returned by get_hospital_data_snapshot
+        hospital_gdf: hospital locations GeoPandas dataframe
+        raw_ratings: Raw hospital ratings Pandas dataframe as returned by the CMS API
+        raw_survey: Raw hospital survey Pandas dataframe as returned by the CMS API
+    """
+    hospital_ratings = clean_hospital_ratings(raw_ratings)
+    hospital_survey = aggregate_hospital_survey(raw_survey)
+    location_ratings = merge_hospital_location_ratings(hospital_gdf, hospital_ratings)
+    survey_ratings = merge_hospital_rating_survey(location_ratings, hospital_survey).copy()
+    snapshot.update({"measure_descriptions": measure_descriptions(raw_survey),
+                     "hospital_ratings": hospital_ratings,
+                     "hospital_survey": hospital_survey,
+                     "survey_ratings": survey_ratings,
+                     "hospital_index": share_hospital_index(build_hospital_index(survey_ratings))})
+
+
+def patch_hospital_data_snapshot(snapshot, hospital_gdf, raw_ratings, raw_survey, changed, removed):
+    """
+    Re-process only the facilities that changed since the previous snapshot and patch the processed dataframes and the
+    hospital index. The patches are applied to copies which then replace the previous ones in the snapshot, so readers
+    holding the previous dataframes and index never see a half patched state. Must be called holding the snapshot lock
+
+    Parameters:
+        snapshot: Dictionary returned by get_hospital_data_snapshot
+        hospital_gdf: hospital locations GeoPandas dataframe
+        raw_ratings: Raw hospital ratings Pandas dataframe as returned by the CMS API
+        raw_survey: Raw hospital survey Pandas dataframe as returned by the CMS API
+        changed: Set of facility IDs that are new or whose data changed
+        removed: Set of facility IDs that are no longer present
+    """
+    affected = list(changed | removed)
+    changed = list(changed)
+    changed_ratings = clean_hospital_ratings(raw_ratings[raw_ratings['facility_id'].isin(changed)])
+    changed_survey = raw_survey[raw_survey['facility_id'].isin(changed)]
+    descriptions = dict(snapshot["measure_descriptions"], **measure_descriptions(changed_survey))
+    if len(changed_survey) > 0:
+        changed_survey = aggregate_hospital_survey(changed_survey)
+    else:
+        changed_survey = snapshot["hospital_survey"].iloc[:0]
+
+    hospital_ratings = snapshot["hospital_ratings"]
+    hospital_ratings = pd.concat([hospital_ratings[~hospital_ratings['facility_id'].isin(affected)], changed_ratings])
+    hospital_survey = snapshot["hospital_survey"]
+    hospital_survey = pd.concat([hospital_survey[~hospital_survey['facility_id'].isin(affected)], changed_survey],
+                                ignore_index=True)
+
+    changed_location_ratings = merge_hospital_location_ratings(hospital_gdf, changed_ratings)
+    changed_rows = merge_hospital_rating_survey(changed_location_ratings, changed_survey).copy()
+
+    survey_ratings = snapshot["survey_ratings"]
+    hospital_index = snapshot["hospital_index"]
+    positions = np.flatnonzero(survey_ratings['facility_id'].isin(affected).to_numpy())
+    same_rows = np.array_equal(survey_ratings['facility_id'].to_numpy()[positions],
+                               changed_rows['facility_id'].to_numpy())
+    same_states = np.isin(changed_rows['state'].to_numpy(dtype=str), hospital_index["state_codes"]).all()
+    same_columns = feature_columns(changed_rows) == hospital_index["columns"]
+    if same_rows and same_states and same_columns:
+        # The same facilities and survey measures are still present, so only their rows and index entries are
+        # overwritten
+        survey_ratings = survey_ratings.copy()
+        changed_rows.index = survey_ratings.index[positions]
+        survey_ratings.loc[changed_rows.index, changed_rows.columns] = changed_rows
+        hospital_index = dict(hospital_index,
+                              features=np.array(hospital_index["features"]),
+                              state_ids=hospital_index["state_ids"].copy())
+        patch_hospital_index(hospital_index, survey_ratings, positions)
+    else:
+        survey_ratings = pd.concat([survey_ratings.drop(survey_ratings.index[positions]), changed_rows],
+                                   ignore_index=True)
+        hospital_index = build_hospital_index(survey_ratings)
+    snapshot.update({"measure_descriptions": descriptions,
+                     "hospital_ratings": hospital_ratings,
+                     "hospital_survey": hospital_survey,
+                     "survey_ratings": survey_ratings,
+                     "hospital_index": share_hospital_index(hospital_index)})
+
+
+@st.cache(ttl=3*60*60, suppress_st_warning=True, allow_output_mutation=True)
+def download_cms_data(url):
+    """
+    Download a CMS data set and fingerprint its rows by facility_id. Every rerun until the ttl expires gets the same
+    dataframe and fingerprints back, so they are only hashed once per download
+
+    Parameters:
+        url: CMS API endpoint to download
+
+    Returns:
+        Raw Pandas dataframe as returned by the CMS API and the Pandas series of fingerprints returned by
+        hash_rows_by_key
+    """
+    df = query_cms_api(url)
+    return df, hash_rows_by_key(df, 'facility_id')
+
+
+def refresh_hospital_data(hospital_gdf, ratings_download, survey_download):
+    """
+    Bring the processed CMS hospital data up to date with the latest downloads. The first time this is called
+    everything is built from scratch. When a download has been refreshed (once the ttl of download_cms_data expires)
+    the new data is diffed against the previous snapshot by facility_id and only the facilities that changed are
+    re-aggregated, re-merged and re-indexed, so the cost of a refresh scales with the amount of change instead of the
+    size of the data set. Reruns in between find the same downloads in the snapshot and return right away
+
+    Parameters:
+        hospital_gdf: hospital locations GeoPandas dataframe
+        ratings_download: Hospital ratings data set and fingerprints as returned by download_cms_data
+        survey_download: Hospital survey data set and fingerprints as returned by download_cms_data
+
+    Returns:
+        Dictionary containing the hospital_ratings, hospital_survey and survey_ratings Pandas dataframes, the
+        hospital_index used by recommend_hospitals and the question text of each survey measure. These are never
+        modified by later refreshes, which replace them in the snapshot instead
+    """
+    raw_ratings, ratings_hashes = ratings_download
+    raw_survey, survey_hashes = survey_download
+    snapshot = get_hospital_data_snapshot()
+    with snapshot["lock"]:
+        if "survey_ratings" not in snapshot:
+            build_hospital_data_snapshot(snapshot, hospital_gdf, raw_ratings, raw_survey)
+        elif snapshot["ratings_hashes"] is not ratings_hashes or snapshot["survey_hashes"] is not survey_hashes:
+            changed_ratings, removed_ratings = diff_key_hashes(snapshot["ratings_hashes"], ratings_hashes)
+            changed_survey, removed_survey = diff_key_hashes(snapshot["survey_hashes"], survey_hashes)
+            changed = changed_ratings | changed_survey
+            removed = removed_ratings | removed_survey
+            if changed or removed:
+                patch_hospital_data_snapshot(snapshot, hospital_gdf, raw_ratings, raw_survey, changed, removed)
+        snapshot["ratings_hashes"] = ratings_hashes
+        snapshot["survey_hashes"] = survey_hashes
+        # Readers get their own references to the current data, taken under the lock so they always match each other
+        return {key: snapshot[key] for key in HOSPITAL_DATA_KEYS}
+
+
+@st.cache(ttl=3*60*60, suppress_st_warning=True, allow_output_mutation=True)
 def gather_covid_data():
     """
-    Gather U.S county-level COVID-19 data using the Arcgis web API to pull down the data
+    Gather U.S county-level COVID-19 data using the Arcgis web API to pull down the data. Only the fields used by the
+    app are requested and the county geometry is simplified on the server since it is only used for plotting
 
     Returns:
-        COVID-19 data in a GeoPandas dataframe
+        Dictionary containing the COVID-19 data in a GeoPandas dataframe ("data") along with the data and bounds of each
+        state, as returned by partition_geodataframe
     """
-    url = 'https://services5.arcgis.com/qWZ7BaZXaP5isnfT/arcgis/rest/services/Community_Profile_Report_Counties/FeatureServer/0/'
-    gdf = query_arcgis_feature_server(url)
-    gdf = gdf[~gdf.County.str.startswith("Unallocated")]
-    return gdf
+    gdf = query_arcgis_feature_server(COVID_FEATURE_SERVER_URL,
+                                      out_fields=COVID_FIELDS,
+                                      where="County NOT LIKE 'Unallocated%'",
+                                      geometry_precision=4,
+                                      max_allowable_offset=0.01)
+    return partition_geodataframe(gdf, "State_Abbreviation")
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def random_query_generator(hospitals, n=100):
+# Number of random queries drawn from each generator spawned from the seed, which keeps the queries independent of the
+# chunk size they are consumed in
+RANDOM_QUERY_BLOCK_SIZE = 10000
+
+
+def random_query_space(hospitals):
     """
-    Random query generator to generate queries to be used to test recommendation system
+    Compute the values random queries are drawn from. This only needs to be done once no matter how many queries are
+    generated
 
     Parameters:
         hospitals: hospital information as a Pandas dataframe
+
+    Returns:
+        Numpy array of the sorted unique states and a numpy array of the lowest rating of each rating column
+    """
+    states = np.sort(hospitals["state"].unique())
+    lows = np.array([int(hospitals[column].min()) for column in RATING_COLUMNS])
+    return states, lows
+
+
+def draw_random_queries(rng, states, lows, n):
+    """
+    Draw a batch of random queries with a single vectorized call per column
+
+    Parameters:
+        rng: numpy random Generator to draw the queries with
+        states: Numpy array of states to choose from
+        lows: Numpy array of the lowest rating of each rating column, ratings are drawn between this and 100
         n: number of random queries to be generated
 
     Returns:
-        Pandas dataframe of random queries that will be used to test the recommendation system
+        Pandas dataframe of random queries
     """
-    qs = [[random.choice(hospitals["state"].unique()),
-           random.randint(int(hospitals["doctors"].min()), 100),
-           random.randint(int(hospitals["nurses"].min()), 100),
-           random.randint(int(hospitals["staffs"].min()), 100),
-           random.randint(int(hospitals["patients"].min()), 100)] for i in range(n)]
-    df_queries = pd.DataFrame(qs,
-                              columns=['selected_state',
-                                       'doctor_rating',
-                                       'nurses_rating',
-                                       'staff_rating',
-                                       'patient_rating'])
+    df_queries = pd.DataFrame(rng.integers(lows, 101, size=(n, len(lows))), columns=QUERY_RATING_KEYS)
+    df_queries.insert(0, 'selected_state', pd.Categorical.from_codes(rng.integers(0, len(states), size=n), states))
     return df_queries
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def generate_recs_base_for_rand_queries(query_list, hospitals):
+def random_query_chunks(hospitals, n=100, chunk_size=100000, seed=42):
     """
-    Generate recommendations for a list of queries, which are actually a Pandas dataframe
+    Random query generator that yields the queries in chunks so any number of queries can be generated in constant
+    memory. Queries are drawn in blocks of RANDOM_QUERY_BLOCK_SIZE, each with its own generator spawned from the seed,
+    and the chunks are sliced out of those blocks. The same seed therefore always produces the same stream of queries,
+    whatever the chunk_size and however many queries are requested
 
     Parameters:
-        query_list: random queries as a Pandas dataframe
         hospitals: hospital information as a Pandas dataframe
+        n: number of random queries to be generated
+        chunk_size: maximum number of queries in each chunk
+        seed: seed of the random number generator
 
     Returns:
-        Dictionary of recommendations and top rated hospitals for each query
+        Iterator of Pandas dataframes of random queries
+    """
+    states, lows = random_query_space(hospitals)
+    num_blocks = -(-n // RANDOM_QUERY_BLOCK_SIZE)
+    pending = None
+    for block, block_seed in enumerate(np.random.SeedSequence(seed).spawn(num_blocks)):
+        # Whole blocks are always drawn so a block holds the same queries no matter how many of them are used
+        queries = draw_random_queries(np.random.default_rng(block_seed), states, lows, RANDOM_QUERY_BLOCK_SIZE)
+        queries = queries.iloc[:n - block * RANDOM_QUERY_BLOCK_SIZE]
+        pending = queries if pending is None else pd.concat([pending, queries], ignore_index=True)
+        while len(pending) >= chunk_size:
+            yield pending.iloc[:chunk_size]
+            pending = pending.iloc[chunk_size:].reset_index(drop=True)
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+
+# Metrics tracked by the streaming evaluation and the bin edges used to aggregate them for the section IV charts
+EVALUATION_METRICS = ["Precision", "Recall", "Average Precision", "nDCG"]
+HISTOGRAM_BIN_EDGES = np.linspace(0, 1, 11)
+PR_CURVE_BIN_EDGES = np.linspace(0, 1, 21)
+# Part of the key of the persistent evaluation cache, to be increased whenever the way metrics are computed changes
+EVALUATION_CACHE_VERSION = 2
+
+
+def state_relevance(hospitals, hospital_index):
     """
-    query_rec_dict = {}
-    for i in range(len(query_list)):
-        query = query_list.iloc[i].to_dict()
-        recommendations = recommend_hospitals(hospitals, query)
-        hosp_rel = hospitals[hospitals['state'] == query['selected_state']]
-        hosp_rel = hosp_rel.sort_values(by=['hospital_overall_rating'], ascending=False)
-        hosp_rel = hosp_rel[hosp_rel['hospital_overall_rating'] == hosp_rel['hospital_overall_rating'].values.max()]
-        query_rec_dict["query_{}".format(i)] = [recommendations, hosp_rel]
-    return query_rec_dict
+    Precompute the candidate hospitals and the relevance base (top rated hospitals) of every state so they don't need
+    to be recomputed for each query
 
+    Parameters:
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+        hospital_index: Dictionary returned by build_hospital_index
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def evaluation_pre_rec(queries, survey_ratings, n=-1):
+    Returns:
+        List indexed by state code of tuples containing the row positions of the hospitals in the state and the row
+        positions of the top rated hospitals in the state
     """
-    Calculate precision and recall at n for each query in queries
+    ratings = hospitals[['hospital_overall_rating']].reset_index(drop=True)
+    order = np.argsort(hospital_index["state_ids"], kind="stable")
+    splits = np.cumsum(np.bincount(hospital_index["state_ids"], minlength=len(hospital_index["state_codes"])))[:-1]
+    relevance = []
+    for candidates in np.split(order, splits):
+        # The order of tied hospitals sets the relevance ranks used by nDCG, so changing how they are sorted changes the
+        # metrics and needs a new EVALUATION_CACHE_VERSION
+        hosp_rel = ratings.iloc[candidates].sort_values(by=['hospital_overall_rating'], ascending=False)
+        hosp_rel = hosp_rel[hosp_rel['hospital_overall_rating'] == hosp_rel['hospital_overall_rating'].max()]
+        relevance.append((candidates, hosp_rel.index.to_numpy()))
+    return relevance
+
+
+def evaluate_query_chunk(queries, hospital_index, relevance, n=-1, cutoff=-1, ndcg_n=-1, base=2,
+                         num_recommendations=5):
+    """
+    Calculate precision and recall at n, average precision and nDCG for a chunk of queries. Queries are grouped by
+    state and scored with one matrix product per state instead of building recommendation dataframes per query
 
     Parameters:
         queries: Pandas dataframe of random queries that will be used to test the recommendation system
-        survey_ratings: Pandas dataframe of hospital survey ratings and other information
+        hospital_index: Dictionary returned by build_hospital_index
+        relevance: List returned by state_relevance
         n: Top n results to use to calculate precision and recall per query
+        cutoff: Top n results to use to calculate average precision per query
+        ndcg_n: Top n results to use to calculate nDCG per query
+        base: Base of the logarithm function used to discount relevance scores
+        num_recommendations: Number of recommendations generated per query
 
     Returns:
-        Two lists, one containing the calculated precision of each query and one for the calculated recall of each query
+        Pandas dataframe containing queries and metrics
     """
-    pre_at_n, rec_at_n = [], []
-    query_rec_base = generate_recs_base_for_rand_queries(queries, survey_ratings)
-    for q_id, recs in query_rec_base.items():
-        recommendations = recs[0]
-        hosp_rel = recs[1]
-        if (n != -1) and (n <= len(recommendations)):
-            recommendations = recommendations.iloc[:n]
-        numerator = len(set(recommendations['facility_id']).intersection(hosp_rel['facility_id']))
-        if numerator != 0:
-            pre_at_n.append(numerator / len(recommendations))
-            rec_at_n.append(numerator / len(hosp_rel))
-        else:
-            pre_at_n.append(0)
-            rec_at_n.append(0)
-    return pre_at_n, rec_at_n
+    query, _ = weighted_query(hospital_index, dict.fromkeys(RATING_COLUMNS, 1))
+    rating_positions = [hospital_index["column_index"][column] for column in RATING_COLUMNS]
+    users = queries[QUERY_RATING_KEYS].to_numpy(dtype=np.float32)
+    user_norms = np.linalg.norm(users, axis=1)
+    query_codes = np.searchsorted(hospital_index["state_codes"], queries['selected_state'].to_numpy(dtype=str))
+    metrics = np.zeros((len(queries), len(EVALUATION_METRICS)))
+    for code in np.unique(query_codes):
+        rows = np.flatnonzero(query_codes == code)
+        candidates, relevant = relevance[code]
+        k = min(num_recommendations, len(candidates))
+        if k == 0:
+            continue
+        # One matrix product gives the dot products with every query and the squared norms of the hospitals
+        user_queries = np.zeros((hospital_index["features"].shape[1], len(rows) + 1), dtype=np.float32)
+        user_queries[rating_positions, :-1] = users[rows].T
+        user_queries[:, -1] = query[:, 1]
+        products = hospital_index["features"][candidates] @ user_queries
+        norms = np.sqrt(products[:, -1])[None, :] * user_norms[rows][:, None]
+        scores = np.divide(products[:, :-1].T, norms, out=np.zeros_like(norms), where=norms > 0)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < len(candidates) else \
+            np.tile(np.arange(k), (len(rows), 1))
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable"),
+                                 axis=1)
+        recommended = candidates[top]
+        relevant_rank = np.full(len(hospital_index["state_ids"]), -1)
+        relevant_rank[relevant] = np.arange(len(relevant))
+        ranks = relevant_rank[recommended]
+        hits = ranks >= 0
+
+        retrieved = n if (n != -1) and (n <= k) else k
+        numerator = hits[:, :retrieved].sum(axis=1)
+        metrics[rows, 0] = numerator / retrieved
+        metrics[rows, 1] = numerator / len(relevant)
+
+        retrieved = cutoff if (cutoff != -1) and (cutoff <= k) else k
+        positions = np.arange(1, retrieved + 1)
+        precisions = np.where(hits[:, :retrieved], np.cumsum(hits[:, :retrieved], axis=1) / positions, 0)
+        metrics[rows, 2] = precisions.sum(axis=1) / len(relevant)
+
+        retrieved = ndcg_n if (ndcg_n != -1) and (ndcg_n <= k) else k
+        positions = np.arange(1, retrieved + 1)
+        discounts = np.where(positions < base, 1, 1 / (np.log(np.maximum(positions, 2)) / math.log(base)))
+        retrieved_scores = np.where(hits[:, :retrieved], len(relevant) + 1 - ranks[:, :retrieved], 1)
+        ideal_scores = np.where(positions <= len(relevant), len(relevant) + 2 - positions, 1)
+        metrics[rows, 3] = (retrieved_scores * discounts).sum(axis=1) / (ideal_scores * discounts).sum()
+    query_metrics = queries.copy(deep=True)
+    for i, metric in enumerate(EVALUATION_METRICS):
+        query_metrics[metric] = metrics[:, i]
+    return query_metrics
+
+
+def update_evaluation_summary(summary, query_metrics, sample_size=5):
+    """
+    Update the running aggregates of a streaming evaluation with the metrics of a chunk of queries
+
+    Parameters:
+        summary: Dictionary of running aggregates, updated in place
+        query_metrics: Pandas dataframe containing queries and metrics as returned by evaluate_query_chunk
+        sample_size: Number of queries to keep as an example of the collected metrics
+    """
+    summary["count"] += len(query_metrics)
+    for metric in EVALUATION_METRICS:
+        values = query_metrics[metric].to_numpy()
+        summary["sums"][metric] += values.sum()
+        summary["histograms"][metric] += np.histogram(values, bins=HISTOGRAM_BIN_EDGES)[0]
+    recall_bins = np.clip(np.digitize(query_metrics["Recall"].to_numpy(), PR_CURVE_BIN_EDGES) - 1,
+                          0, len(PR_CURVE_BIN_EDGES) - 2)
+    summary["pr_curve_counts"] += np.bincount(recall_bins, minlength=len(PR_CURVE_BIN_EDGES) - 1)
+    summary["pr_curve_precision_sums"] += np.bincount(recall_bins, weights=query_metrics["Precision"].to_numpy(),
+                                                      minlength=len(PR_CURVE_BIN_EDGES) - 1)
+    if len(summary["sample"]) < sample_size:
+        summary["sample"] = pd.concat([summary["sample"], query_metrics.iloc[:sample_size - len(summary["sample"])]],
+                                      ignore_index=True)
 
 
 @st.cache(ttl=3*60*60, suppress_st_warning=True)
-def evaluation_mean_avg_pre(queries, survey_ratings, cutoff=-1):
+def evaluation_streaming(hospitals, num_queries=5000, chunk_size=1000, seed=42, n=-1, cutoff=-1, ndcg_n=-1, base=2):
     """
-    Calculate (mean) average precision for each query in queries
+    Evaluate the recommendation system on random queries that are generated and consumed in chunks. Only running
+    aggregates of the metrics are kept so memory stays flat no matter how many queries are evaluated
 
     Parameters:
-        queries: Pandas dataframe of random queries that will be used to test the recommendation system
-        survey_ratings: Pandas dataframe of hospital survey ratings and other information
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+        num_queries: number of random queries to evaluate
+        chunk_size: number of queries generated and evaluated at a time
+        seed: seed of the random number generator used to generate the queries
+        n: Top n results to use to calculate precision and recall per query
         cutoff: Top n results to use to calculate average precision per query
+        ndcg_n: Top n results to use to calculate nDCG per query
+        base: Base of the logarithm function used to discount relevance scores
 
     Returns:
-        List of average precisions for each query and the mean average precision
-    """
-    avg_pre = []
-    all_pres = []
-    query_rec_base = generate_recs_base_for_rand_queries(queries, survey_ratings)
-    for q_id, recs in query_rec_base.items():
-        precisions = []
-        recommendations = recs[0]
-        hosp_rel = recs[1]
-        retrieved = recommendations
-        not_retrieved = []
-        if (cutoff != -1) and (cutoff <= len(recommendations)):
-            retrieved = recommendations[:cutoff]
-            not_retrieved = recommendations[cutoff:]
-        for j in range(1, len(retrieved) + 1):
-            docs = retrieved[:j]
-            if docs.iloc[-1]['facility_id'] in hosp_rel['facility_id'].tolist():
-                numerator = len(set(docs['facility_id']).intersection(hosp_rel['facility_id']))
-                if numerator != 0:
-                    precisions.append(numerator/len(docs))
-                else:
-                    precisions.append(0)
-        for doc in not_retrieved:
-            if doc in hosp_rel:
-                precisions.append(0)
-        avg_pre.append(sum(precisions) / len(hosp_rel))
-        all_pres.append(sum(precisions) / len(hosp_rel))
-    mean_avg_pre = sum(all_pres) / len(all_pres)
-    return avg_pre, mean_avg_pre
+        Dictionary containing the number of queries evaluated, the sum and histogram of each metric, the precision
+        sums and counts per recall bin and a small sample of the per query metrics
+    """
+    hospital_index = build_hospital_index(hospitals)
+    relevance = state_relevance(hospitals, hospital_index)
+    summary = {"count": 0,
+               "sums": {metric: 0.0 for metric in EVALUATION_METRICS},
+               "histograms": {metric: np.zeros(len(HISTOGRAM_BIN_EDGES) - 1, dtype=np.int64)
+                              for metric in EVALUATION_METRICS},
+               "pr_curve_counts": np.zeros(len(PR_CURVE_BIN_EDGES) - 1, dtype=np.int64),
+               "pr_curve_precision_sums": np.zeros(len(PR_CURVE_BIN_EDGES) - 1),
+               "sample": pd.DataFrame()}
+    for queries in random_query_chunks(hospitals, num_queries, chunk_size, seed):
+        query_metrics = evaluate_query_chunk(queries, hospital_index, relevance, n, cutoff, ndcg_n, base)
+        update_evaluation_summary(summary, query_metrics)
+    return summary
 
 
 @st.cache(ttl=3*60*60, suppress_st_warning=True)
-def evaluation_ndcg(queries, survey_ratings, n=-1, base=2):
+def load_evaluation_summary(hospitals, num_queries=5000, chunk_size=1000, seed=42, n=-1, cutoff=-1, ndcg_n=-1,
+                            base=2):
     """
-    Calculate NDCG at n for each query in queries
+    Get the results of evaluation_streaming from a persistent cache in app/data/cache. Results are stored under a hash
+    of the hospital data they were computed from, the query seed and count and the metric parameters, so restarts and
+    new replicas load them right away and the evaluation is only rerun when one of those inputs changes
 
     Parameters:
-        queries: Pandas dataframe of random queries that will be used to test the recommendation system
-        survey_ratings: Pandas dataframe of hospital survey ratings and other information
-        n: Top n results to use to calculate nDCG per query
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+        num_queries: number of random queries to evaluate
+        chunk_size: number of queries generated and evaluated at a time
+        seed: seed of the random number generator used to generate the queries
+        n: Top n results to use to calculate precision and recall per query
+        cutoff: Top n results to use to calculate average precision per query
+        ndcg_n: Top n results to use to calculate nDCG per query
         base: Base of the logarithm function used to discount relevance scores
 
     Returns:
-        List of nDCGs for each query
-    """
-    ndcg = []
-    query_rec_base = generate_recs_base_for_rand_queries(queries, survey_ratings)
-    for q_id, recs in query_rec_base.items():
-        recommendations = recs[0]
-        hosp_rel = recs[1]
-        j_doc_scores = list(range(len(hosp_rel) + 1, 1, -1))
-        if len(recommendations) > len(j_doc_scores):
-            j_doc_scores = j_doc_scores + ([1]*(len(recommendations) - len(j_doc_scores)))
-        retrieved_scores = []
-        for doc in recommendations["facility_id"].tolist():
-            counter = 0
-            if doc in hosp_rel["facility_id"].tolist():
-                retrieved_scores.append(j_doc_scores[hosp_rel["facility_id"].tolist().index(doc)])
-            else:
-                retrieved_scores.append(1)
-            counter += 1
-        if (n != -1) and (n <= len(recommendations)):
-            retrieved_scores = retrieved_scores[:n]
-        j_doc_scores = j_doc_scores[:len(retrieved_scores)]
-        rs_sum = 0
-        for j, val in enumerate(retrieved_scores):
-            if j+1 < base:
-                rs_sum += val
-            else:
-                rs_sum += (val / math.log(j+1, base))
-        jd_sum = 0
-        for k, val in enumerate(j_doc_scores):
-            if k+1 < base:
-                jd_sum += val
-            else:
-                jd_sum += (val / math.log(k+1, base))
-        ndcg.append(rs_sum/jd_sum)
-    return ndcg
+        Dictionary returned by evaluation_streaming
+    """
+    data_version = hash_dataframe(hospitals[['facility_id', 'state', 'hospital_overall_rating'] + RATING_COLUMNS])
+    # chunk_size only changes how much memory the evaluation uses, not its results, so it isn't part of the key
+    key_parts = [EVALUATION_CACHE_VERSION, data_version, num_queries, seed, n, cutoff, ndcg_n, base]
+    cache_dir = os.path.join(os.getcwd(), "app", "data", "cache")
+    return disk_cached(cache_dir, "evaluation", key_parts,
+                       lambda: evaluation_streaming(hospitals, num_queries, chunk_size, seed, n, cutoff, ndcg_n, base))
 
 
-@st.cache(ttl=3*60*60, suppress_st_warning=True)
-def add_metrics_to_queries(queries, pre_at_n, rec_at_n, avg_pre, ndcg):
+def evaluation_summary_frames(summary):
     """
-    Add the evaluation metrics to the queries dataframe
+    Convert the running aggregates of a streaming evaluation into the dataframes used to plot the section IV charts
 
     Parameters:
-        queries: Pandas dataframe of random queries that was used to test the recommendation system
-        pre_at_n: List of precisions (one entry per query)
-        rec_at_n: List or recalls (one entry per query)
-        avg_pre: List of average precisions (one entry per query)
-        ndcg: List of nDCG (one entry per query)
+        summary: Dictionary returned by evaluation_streaming
 
     Returns:
-        Pandas dataframe containing queries and metrics
+        Pandas dataframe of histogram bins (metric, bin_start, bin_end, count) and Pandas dataframe of the mean
+        precision per recall bin (Recall, Precision)
     """
-    query_metrics = queries.copy(deep=True)
-    query_metrics["Precision"] = pre_at_n
-    query_metrics["Recall"] = rec_at_n
-    query_metrics["Average Precision"] = avg_pre
-    query_metrics["nDCG"] = ndcg
-    return query_metrics
+    histograms = pd.concat([pd.DataFrame({"metric": metric,
+                                          "bin_start": HISTOGRAM_BIN_EDGES[:-1],
+                                          "bin_end": HISTOGRAM_BIN_EDGES[1:],
+                                          "count": summary["histograms"][metric]})
+                            for metric in EVALUATION_METRICS], ignore_index=True)
+    counts = summary["pr_curve_counts"]
+    filled = counts > 0
+    pr_curve = pd.DataFrame({"Recall": ((PR_CURVE_BIN_EDGES[:-1] + PR_CURVE_BIN_EDGES[1:]) / 2)[filled],
+                             "Precision": summary["pr_curve_precision_sums"][filled] / counts[filled]})
+    return histograms, pr_curve
+
+
+def feature_columns(hospitals):
+    """
+    Column registry of the feature store: the four rating buckets, every HCAHPS measure (the columns named by their
+    hcahps_measure_id, which all start with H_) and the overall hospital rating
+
+    Parameters:
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+
+    Returns:
+        List of column names in the order they are stored in the feature matrix
+    """
+    measures = sorted(column for column in hospitals.columns if column.startswith("H_"))
+    return RATING_COLUMNS + measures + ['hospital_overall_rating']
+
+
+def feature_matrix(hospitals, columns):
+    """
+    Dense float32 feature matrix of the given columns followed by their squares. The overall hospital rating is
+    rescaled from 1-5 stars to the 0-100 scale of the survey measures. Keeping the squares next to the features lets
+    the numerator and the norm of a weighted cosine similarity come out of one matrix product
 
+    Parameters:
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+        columns: List of column names as returned by feature_columns
 
-def recommend_hospitals(hospitals, user, num_recommendations=5):
+    Returns:
+        Numpy float32 array with one row per hospital and two columns per feature
+    """
+    features = hospitals[columns].to_numpy(dtype=np.float32)
+    features[:, columns.index('hospital_overall_rating')] *= OVERALL_RATING_SCALE
+    return np.hstack([features, np.square(features)])
+
+
+def build_hospital_index(hospitals):
+    """
+    Build the feature store used by the recommender over every hospital in the country. Every survey measure and the
+    overall rating are kept in one dense float32 matrix along with a registry of its columns, so a query over any
+    weighted subset of the columns only needs a single matrix product to get cosine similarity, and states are encoded
+    as integer codes so any set of states can be turned into a boolean mask without string compares
+
+    Parameters:
+        hospitals: Pandas dataframe of hospital survey ratings and other information
+
+    Returns:
+        Dictionary containing the feature matrix, the list of feature columns, a dictionary of column name to position
+        in the feature matrix, the sorted state codes and the state code of each hospital
+    """
+    columns = feature_columns(hospitals)
+    state_codes, state_ids = np.unique(hospitals['state'].to_numpy(dtype=str), return_inverse=True)
+    return {"features": feature_matrix(hospitals, columns),
+            "columns": columns,
+            "column_index": {column: i for i, column in enumerate(columns)},
+            "state_codes": state_codes,
+            "state_ids": state_ids}
+
+
+def share_hospital_index(hospital_index):
+    """
+    Replace the feature matrix of the hospital index with a memory-mapped copy stored in app/data/cache, so every
+    worker process on the host serving the same data shares one copy of it
+
+    Parameters:
+        hospital_index: Dictionary returned by build_hospital_index, updated in place
+
+    Returns:
+        The hospital_index dictionary
+    """
+    cache_dir = os.path.join(os.getcwd(), "app", "data", "cache")
+    hospital_index["features"] = share_array(hospital_index["features"], cache_dir, "hospital_index")
+    return hospital_index
+
+
+def patch_hospital_index(hospital_index, hospitals, positions):
+    """
+    Recompute the entries of the hospital index for the given rows in place. The states of the patched rows must
+    already be present in the index
+
+    Parameters:
+        hospital_index: Dictionary returned by build_hospital_index
+        hospitals: Pandas dataframe of hospital survey ratings and other information the index was built from
+        positions: Numpy array of row positions in hospitals that changed
+    """
+    hospital_index["features"][positions] = feature_matrix(hospitals.iloc[positions], hospital_index["columns"])
+    hospital_index["state_ids"][positions] = np.searchsorted(hospital_index["state_codes"],
+                                                             hospitals['state'].iloc[positions].to_numpy(dtype=str))
+
+
+def weighted_query(hospital_index, ratings, weights=None):
+    """
+    Turn the ideal ratings of a query into the vector the feature matrix is multiplied by. Multiplying the feature
+    matrix by it gives, for each hospital, the weighted dot product with the query and the weighted squared norm of the
+    hospital over the queried columns
+
+    Parameters:
+        hospital_index: Dictionary returned by build_hospital_index
+        ratings: Dictionary of feature column name to ideal rating
+        weights: Dictionary of feature column name to weight, columns that aren't given have a weight of 1
+
+    Returns:
+        Numpy float32 array of shape (2 * number of features, 2) and the weighted norm of the query
+    """
+    weights = weights or {}
+    unknown = set(ratings).union(weights).difference(hospital_index["column_index"])
+    if unknown:
+        raise ValueError("Unknown feature columns: {}".format(", ".join(sorted(unknown))))
+    num_features = len(hospital_index["columns"])
+    query = np.zeros((2 * num_features, 2), dtype=np.float32)
+    user_norm = 0.0
+    for column, rating in ratings.items():
+        i = hospital_index["column_index"][column]
+        weight = weights.get(column, 1)
+        query[i, 0] = weight * rating
+        query[num_features + i, 1] = weight
+        user_norm += weight * rating ** 2
+    return query, math.sqrt(user_norm)
+
+
+def cosine_scores(products, user_norm):
+    """
+    Cosine similarity from the output of multiplying the feature matrix by a weighted query
+
+    Parameters:
+        products: Numpy array of shape (number of hospitals, 2) returned by features @ query
+        user_norm: Weighted norm of the query
+
+    Returns:
+        Numpy array of the cosine similarity of each hospital, 0 where either vector is all zeros
+    """
+    norms = np.sqrt(products[:, 1]) * user_norm
+    return np.divide(products[:, 0], norms, out=np.zeros(len(products), dtype=products.dtype), where=norms > 0)
+
+
+def state_mask(hospital_index, selected_states=None):
+    """
+    Create a boolean mask over the hospital index for the given states
+
+    Parameters:
+        hospital_index: Dictionary returned by build_hospital_index
+        selected_states: Single state abbreviation, collection of state abbreviations or None for the whole country
+
+    Returns:
+        Numpy boolean array with one entry per hospital, or None if every hospital is included
+    """
+    if selected_states is None:
+        return None
+    if isinstance(selected_states, str):
+        selected_states = [selected_states]
+    allowed = np.isin(hospital_index["state_codes"], list(selected_states))
+    return allowed[hospital_index["state_ids"]]
+
+
+def top_k_indices(scores, k):
+    """
+    Indices of the k highest scores in descending order, using a partial sort so only the top k are fully sorted
+
+    Parameters:
+        scores: Numpy array of scores
+        k: Number of indices to return
+
+    Returns:
+        Numpy array of at most k indices into scores
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.array([], dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def recommend_hospitals(hospitals, user, num_recommendations=5, hospital_index=None):
     """
     Generate hospital recommendations using cosine similarity.
-    Hospitals are first filtered by the user-specified state and then cosine similarity is taken between user entered
+    Hospitals are first filtered by the user-specified state(s) and then cosine similarity is taken between user entered
     parameters and hospital ratings for doctor_rating, nurses_rating, staff_rating, and patient_rating.
 
+    The selected_state entry of the user dictionary can be a single state, a collection of states or None to search
+    the whole country. Scoring is done against the precomputed national index so the cost of a query is about the
+    same no matter how many states are searched.
+
+    Any other column of the feature store (see feature_columns) can be added to the query through an optional ratings
+    entry of the user dictionary mapping column names to ideal ratings, and an optional weights entry mapping column
+    names to weights gives some columns more importance than others.
+
     Parameters:
         hospitals: Pandas dataframe of hospital survey ratings and other information
-        user: Dictionary of user data containing parameters specified by the user (state, doctor_rating, nurses_rating, staff_rating, patient_rating)
+        user: Dictionary of user data containing parameters specified by the user (state, doctor_rating, nurses_rating, staff_rating, patient_rating, ratings, weights)
         num_recommendations: Number of recommendations to generate
+        hospital_index: Index returned by build_hospital_index for hospitals, built on demand if not provided
 
     Returns:
         Pandas dataframe of the top num_recommendations recommended hospitals
     """
-    collab_filtered = hospitals[hospitals['state'] == user["selected_state"]]
-    hospital_arr = collab_filtered[['doctors', 'nurses', 'staffs', 'patients']].to_numpy()
-    user_arr = np.array([user['doctor_rating'],
-                         user['nurses_rating'],
-                         user['staff_rating'],
-                         user['patient_rating']]).reshape(1, -1)
-    cosim = cosine_similarity(user_arr, hospital_arr)[0]
-    collab_filtered['Cosine Similarity'] = cosim
-    final = collab_filtered.sort_values('Cosine Similarity', ascending=False).reset_index().iloc[0:num_recommendations]
+    if hospital_index is None:
+        hospital_index = build_hospital_index(hospitals)
+    ratings = {column: user[key] for key, column in zip(QUERY_RATING_KEYS, RATING_COLUMNS) if key in user}
+    ratings.update(user.get("ratings", {}))
+    query, user_norm = weighted_query(hospital_index, ratings, user.get("weights"))
+    cosim = cosine_scores(hospital_index["features"] @ query, user_norm)
+    mask = state_mask(hospital_index, user.get("selected_state"))
+    candidates = np.arange(len(cosim)) if mask is None else np.flatnonzero(mask)
+    rows = candidates[top_k_indices(cosim[candidates], num_recommendations)]
+    final = hospitals.iloc[rows]
+    final['Cosine Similarity'] = cosim[rows]
+    final = final.reset_index()
     return final
 
 
@@ -427,7 +987,8 @@ def main():
         
         In this app, all data is cached once it has been loaded. By caching the data instead of access the files any time 
         new recommendations are requested we can quickly make and present new recommendations in 1-2 seconds instead of 
-        having to reload and process all the required data which would take approximately 1-2 minute.
+        having to reload and process all the required data which would take approximately 1-2 minute. When the cached 
+        CMS data is refreshed, only the facilities whose data changed since the previous download are reprocessed.
         ### Static Data Sets
         * statelatlong.csv
             * United States latitude and longitude coordinates that will be used as default state locations when plotting recommended hospital locations when no COVID-19 data is to be plotted. Originally downloaded from https://www.kaggle.com/datasets/washimahmed/usa-latlong-for-state-abbreviations
@@ -445,12 +1006,15 @@ def main():
             * U.S county-level COVID-19 data for the past 7 days. 
             * Accessed via the HHS Public Protect Hub API: https://protect-public.hhs.gov/datasets/cad5b70395a04b95936f0286be30e282/api
         """)
-    state_locations = load_state_locations()
-    hospital_gdf = load_hospital_locations()
-    hospital_ratings = load_hospital_ratings()
-    hospital_survey = load_hospital_survey()
-    location_ratings = merge_hospital_location_ratings(hospital_gdf, hospital_ratings)
-    survey_ratings = merge_hospital_rating_survey(location_ratings, hospital_survey)
+    app_data, load_timings = load_app_data()
+    st.sidebar.caption("Data loaded in {:.2f}s (critical path {:.2f}s)".format(load_timings["total"],
+                                                                               load_timings["critical_path"]))
+    state_locations = app_data["state_locations"]
+    hospital_data = app_data["hospital_data"]
+    hospital_ratings = hospital_data["hospital_ratings"]
+    hospital_survey = hospital_data["hospital_survey"]
+    survey_ratings = hospital_data["survey_ratings"]
+    hospital_index = hospital_data["hospital_index"]
     st.markdown(
         """
         #### Hospital General Information
@@ -475,7 +1039,7 @@ def main():
         """
         We then looked through each of the Measures, which contain sub-questions. For our hospital recommendation model, we 
         were interested in Composite 1, 2, 3, and 5. In total, this amounts to four patient-centric model parameters, which 
-        consist of 14 sub-parameters. The full list of parameters we used can be found below.
+        consist of 14 sub-parameters. The full list of parameters we used for these four can be found below.
         """)
     st.markdown(hide_table_row_index, unsafe_allow_html=True)
     st.table(pd.DataFrame(data={"Nurses": ["H_COMP_1_A_P", "H_NURSE_RESPECT_A_P", "H_NURSE_LISTEN_A_P", "H_NURSE_EXPLAIN_A_P"],
@@ -487,9 +1051,17 @@ def main():
         """
         For each hospital, we took the mean of sub parameters to determine an overall score for each parameter. These four 
         measures then became hospital parameters for our recommendation engine to score against patient inputs.
+        
+        Every other HCAHPS measure (e.g. cleanliness, quietness, and receiving timely medication) is kept as well, 
+        along with the overall hospital rating. All of them are stored in a single feature matrix next to their squares, 
+        so the recommendation engine gets the weighted cosine similarity of every hospital from one product with a two 
+        column query matrix. Users can therefore optionally add any of these measures to their query and choose an ideal 
+        rating and a weight for each of them. Some measures count the least favorable 
+        answers (e.g. "sometimes or never", or hospital ratings of 0 to 6), so their suggested ideal rating is the 
+        lowest one.
         """)
     st.markdown(hide_table_row_index, unsafe_allow_html=True)
-    st.table(hospital_survey.head())
+    st.table(hospital_survey[['facility_id'] + RATING_COLUMNS].head())
     st.caption("Example of hospital survey dataframe")
     st.markdown(
         """
@@ -522,6 +1094,11 @@ def main():
         similarity) are collected and presented to the user along with a map of their locations as well as county-level 
         COVID-19 data for the user selected state if the user requests it. An interactive example is provided in section V. 
         Mapping Recommended Hospital Locations and Ease of Practical Use.
+        
+        Patients near state borders can also include additional states in their search or search the whole country. 
+        All hospitals are scored against a single precomputed national index of their raw ratings and the squares of 
+        those ratings, with the norms worked out per query, so searching several states or the whole country is just as 
+        fast as searching a single state.
         """)
 
     st.header("IV. Recommendation System Evaluation and Metrics")
@@ -536,11 +1113,10 @@ def main():
         queries for this evaluation. The relevance base that the recommendations are compared against is the CMS top rated 
         hospitals that offer emergency services.
         """)
-    queries = random_query_generator(survey_ratings, 5000)
-    pre_at_n, rec_at_n = evaluation_pre_rec(queries, survey_ratings, 10)
-    avg_pre, mean_avg_precision = evaluation_mean_avg_pre(queries, survey_ratings, 10)
-    ndcg = evaluation_ndcg(queries, survey_ratings)
-    queries_metrics = add_metrics_to_queries(queries, pre_at_n, rec_at_n, avg_pre, ndcg)
+    evaluation_summary = load_evaluation_summary(survey_ratings, num_queries=5000, n=10, cutoff=10)
+    queries_metrics = evaluation_summary["sample"]
+    mean_avg_precision = evaluation_summary["sums"]["Average Precision"] / evaluation_summary["count"]
+    histograms, pr_curve = evaluation_summary_frames(evaluation_summary)
     st.markdown(hide_table_row_index, unsafe_allow_html=True)
     st.table(queries_metrics.head(5))
     st.caption("Example of collected performance metrics for test queries")
@@ -548,25 +1124,29 @@ def main():
         """
         Mean Average Precision: {}
         """.format(mean_avg_precision))
-    pre_hist = alt.Chart(queries_metrics).mark_bar().encode(
-        alt.X("Precision:Q", bin=True),
-        y="count()",
+    pre_hist = alt.Chart(histograms[histograms["metric"] == "Precision"]).mark_bar().encode(
+        alt.X("bin_start:Q", bin="binned", title="Precision"),
+        alt.X2("bin_end:Q"),
+        alt.Y("count:Q", title="Count of Records"),
     ).properties(title="Histogram of Precision for 5000 Test Queries")
-    rec_hist = alt.Chart(queries_metrics).mark_bar().encode(
-        alt.X("Recall:Q", bin=True),
-        y="count()",
+    rec_hist = alt.Chart(histograms[histograms["metric"] == "Recall"]).mark_bar().encode(
+        alt.X("bin_start:Q", bin="binned", title="Recall"),
+        alt.X2("bin_end:Q"),
+        alt.Y("count:Q", title="Count of Records"),
     ).properties(title="Histogram of Recall for 5000 Test Queries")
-    avg_pre_hist = alt.Chart(queries_metrics).mark_bar().encode(
-        alt.X("Average Precision:Q", bin=True),
-        y="count()",
+    avg_pre_hist = alt.Chart(histograms[histograms["metric"] == "Average Precision"]).mark_bar().encode(
+        alt.X("bin_start:Q", bin="binned", title="Average Precision"),
+        alt.X2("bin_end:Q"),
+        alt.Y("count:Q", title="Count of Records"),
     ).properties(title="Histogram of Average Precision for 5000 Test Queries")
-    scatter = alt.Chart(queries_metrics).mark_line().encode(
+    scatter = alt.Chart(pr_curve).mark_line().encode(
         alt.X("Recall:Q"),
         alt.Y("Precision:Q"),
     ).properties(title="Precision-Recall Curve for 5000 Test Queries")
-    ndcg_hist = alt.Chart(queries_metrics).mark_bar().encode(
-        alt.X("nDCG:Q", bin=True),
-        y="count()",
+    ndcg_hist = alt.Chart(histograms[histograms["metric"] == "nDCG"]).mark_bar().encode(
+        alt.X("bin_start:Q", bin="binned", title="nDCG"),
+        alt.X2("bin_end:Q"),
+        alt.Y("count:Q", title="Count of Records"),
     ).properties(title="Histogram nDCG for 5000 Test Queries")
     st.altair_chart((pre_hist | rec_hist) & (scatter | avg_pre_hist) & ndcg_hist, use_container_width=True)
     st.caption("Compiled performance metrics for test queries")
@@ -605,33 +1185,68 @@ def main():
         To test this functionality, you can use the form provided below. The page will be updated any time you hit the 
         Generate Recommendations button.
         """)
-    community_data = gather_covid_data()
+    covid_data = app_data["covid_data"]
+    state_coordinates = index_state_locations(state_locations)
+    measure_labels = {measure: "{} ({})".format(question, measure)
+                      for measure, question in hospital_data["measure_descriptions"].items()}
+    measure_labels["hospital_overall_rating"] = "Overall hospital rating (1-5 stars scaled to 0-100)"
     st.subheader("Please Select Your Recommendation Parameters")
+    # Chosen outside of the form so the form shows a rating and weight for each of them as soon as they are selected
+    extra_measures = st.multiselect(
+        "Optionally, select additional survey measures to include",
+        [column for column in hospital_index["columns"] if column not in RATING_COLUMNS],
+        format_func=lambda column: measure_labels.get(column, column)
+    )
     with st.form(key="my_form"):
         selected_state = st.selectbox(
             "Select the state of interest",
-            sorted(state_locations.State.unique())
+            sorted(state_coordinates)
+        )
+        additional_states = st.multiselect(
+            "Optionally, select additional states to include in the search",
+            sorted(state_coordinates)
         )
+        search_nationally = st.checkbox("Search hospitals in all states")
         doctor_rating = st.slider("Specify your ideal doctor rating", 1, 100)
         nurses_rating = st.slider("Specify your ideal nurses rating", 1, 100)
         staff_rating = st.slider("Specify your ideal staff rating", 1, 100)
         patient_rating = st.slider("Specify your ideal patient rating", 1, 100)
+        extra_ratings, extra_weights = {}, {}
+        for measure in extra_measures:
+            extra_ratings[measure] = st.slider(f"Specify your ideal rating for {measure_labels.get(measure, measure)}",
+                                               1, 100, default_measure_rating(measure), key=f"rating_{measure}")
+            extra_weights[measure] = st.slider(f"Specify the weight of {measure} compared to the ratings above",
+                                               0.0, 2.0, 1.0, key=f"weight_{measure}")
         display_covid = st.selectbox(
             "Do you want to see COVID-19 data by county?",
             ["Yes", "No"]
         )
         pressed = st.form_submit_button("Generate Recommendations")
 
-    community_covid = community_data[community_data.State_Abbreviation == selected_state]
-    state_location = state_locations[state_locations["State"] == selected_state]
+    if search_nationally:
+        selected_states = None
+        community_covid = covid_data["data"]
+        map_location, map_zoom = [39.8283, -98.5795], 4
+        map_bounds = None
+    else:
+        selected_states = sorted({selected_state, *additional_states})
+        community_covid = select_partitions(covid_data, selected_states)
+        # The map is fitted to the counties of the selected states, the state coordinates are only used when there is
+        # no COVID-19 data for any of them
+        map_bounds = partition_bounds(covid_data, selected_states)
+        map_location = np.mean([state_coordinates[state] for state in selected_states], axis=0).tolist()
+        map_zoom = 6 if len(selected_states) == 1 else 5
 
     if pressed:
         recommended = recommend_hospitals(survey_ratings,
-                                          {"selected_state": selected_state,
+                                          {"selected_state": selected_states,
                                            "doctor_rating": doctor_rating,
                                            "nurses_rating": nurses_rating,
                                            "patient_rating": patient_rating,
-                                           "staff_rating": staff_rating})
+                                           "staff_rating": staff_rating,
+                                           "ratings": extra_ratings,
+                                           "weights": extra_weights},
+                                          hospital_index=hospital_index)
 
         st.subheader("Map of Recommended Hospitals")
         st.markdown(
@@ -648,7 +1263,9 @@ def main():
                                                                                           "Cumulative_cases",
                                                                                           "Cumulative_deaths"])
         else:
-            m = folium.Map(location=[state_location["Latitude"], state_location["Longitude"]], zoom_start=6)
+            m = folium.Map(location=map_location, zoom_start=map_zoom)
+            if map_bounds is not None:
+                m.fit_bounds(map_bounds)
         if len(recommended) != 0:
             recommended.apply(lambda row: folium.Marker(location=[row["LATITUDE"], row["LONGITUDE"]],
                                                         tooltip="<b>{}</b><br><b>{}</b><br><b>{},{}</b><br>".format(row["NAME"],
@@ -686,11 +1303,11 @@ def main():
     st.subheader("Increasing Model Parameters")
     st.markdown(
         """
-        Currently, our model accounts for 14/22 questions asked within the CMS HCAHPS survey. We could increase additional 
-        model parameters to capture all survey responses and further isolate buckets of questions. For instance, there are 
-        a number of patient ratings about receiving timely medication, which can become a standalone parameter. Other 
-        parameters could include overall hospital, comprising patient ratings on hospital cleanliness, ambiance, and 
-        quietness.
+        Currently, our four main model parameters are built from 14/22 questions asked within the CMS HCAHPS survey, and 
+        the remaining measures can only be added to a query one by one. We could further isolate buckets of these 
+        questions into parameters of their own. For instance, there are a number of patient ratings about receiving timely 
+        medication, which can become a standalone parameter. Other parameters could include overall hospital, comprising 
+        patient ratings on hospital cleanliness, ambiance, and quietness.
         
         Our current model does not take into account user location which could result in the recommended hospital being a 
         long distance from the users location (ex. user lives in northern California but based on their specified 
@@ -736,5 +1353,41 @@ def main():
         """)
 
 
+def show_profile_reports(reports):
+    """
+    Show the hotspots of the profiled calls of this rerun in the sidebar
+
+    Parameters:
+        reports: List of (function name, .pstats path, hotspot table) tuples collected by profile_call
+    """
+    for name, file_path, hotspots in reports:
+        st.sidebar.subheader("Profile of {}".format(name))
+        st.sidebar.caption(file_path)
+        st.sidebar.markdown(hide_table_row_index, unsafe_allow_html=True)
+        st.sidebar.table(hotspots)
+
+
 if __name__ == '__main__':
-    main()
+    # Profiling is switched on with the HOSPITAL_APP_PROFILE environment variable or the profile URL query parameter.
+    # Functions are only wrapped when requested so a normal rerun runs unprofiled code
+    targets = profile_targets(st.experimental_get_query_params())
+    if not targets:
+        main()
+    else:
+        profile_reports = []
+        if "recommend_hospitals" in targets:
+            recommend_hospitals = profiled(recommend_hospitals, profile_reports)
+        if "query_arcgis_feature_server" in targets:
+            query_arcgis_feature_server = profiled(query_arcgis_feature_server, profile_reports)
+        if "main" in targets:
+            # cProfile only sees the thread it runs in, so the loaders that load_app_data runs in its thread pool are
+            # profiled separately in their worker threads
+            load_state_locations = profiled(load_state_locations, profile_reports)
+            gather_covid_data = profiled(gather_covid_data, profile_reports)
+            load_hospital_locations = profiled(load_hospital_locations, profile_reports)
+            download_cms_data = profiled(download_cms_data, profile_reports)
+            refresh_hospital_data = profiled(refresh_hospital_data, profile_reports)
+            profile_call(profile_reports, main)
+        else:
+            main()
+        show_profile_reports(profile_reports)